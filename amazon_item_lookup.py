@@ -10,8 +10,11 @@ Created on Sun Jun 24 13:01:10 2018
 
 @author: Daniel Koohmarey
 """
-import xmltodict
+from concurrent.futures import ThreadPoolExecutor # pip install futures (python 2 backport)
+from io import BytesIO
+from lxml import etree
 import base64
+import copy
 import hashlib
 import hmac
 import time
@@ -19,58 +22,177 @@ import os
 import urllib
 import requests
 
-class AmazonItemLookup():
+try:
+    # Optional: the cryptography package links a libcrypto whose sha256 compression loop
+    # uses the sha-ni instructions where the cpu has them, unlike some hashlib builds
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes as crypto_hashes
+    from cryptography.hazmat.primitives.hmac import HMAC as CryptoHMAC
+except ImportError:
+    CryptoHMAC = None
+
+# Namespace used by every element of an ItemLookup response
+AWS_NS = '{http://webservices.amazon.com/AWSECommerceService/2013-08-01}'
+
+# Amazon accepts up to 10 comma separated item ids per ItemLookup request
+MAX_IDS_PER_LOOKUP = 10
+
+# Default structure to hold parsed data, deep-copied once per parsed item
+_PARSED_TEMPLATE = {
+    'item_attributes' : {
+        'title' : '',
+        'manufacturer' : '',
+        'model' : '',
+        'item_dimensions' : {
+            'height' : '',
+            'length' : '',
+            'weight' : '',
+            'width' : ''
+        },
+        'size' : '',
+        'warranty' : '',
+        'features' : []
+    },
+    'url' : '',
+    'images' : {
+        'small': {
+            'height': '',
+            'width': '',
+            'url': ''
+        },
+        'medium' : {
+            'height': '',
+            'width': '',
+            'url': ''
+        },
+        'large' : {
+            'height': '',
+            'width': '',
+            'url': ''
+        }
+    },
+    'sales_rank' : '',
+    'price' : '',
+    'description' : ''
+}
+
+# (parsed key, response tag) pairs for the flat item attribute fields
+ATTR_MAP = (
+    ('title', 'Title'),
+    ('manufacturer', 'Manufacturer'),
+    ('model', 'Model'),
+    ('size', 'Size'),
+    ('warranty', 'Warranty')
+)
+
+# (parsed key, response tag) pairs for the item dimension fields
+DIM_MAP = (
+    ('height', 'Height'),
+    ('length', 'Length'),
+    ('weight', 'Weight'),
+    ('width', 'Width')
+)
+
+# (parsed key, response tag) pairs for the item image sizes
+IMAGE_MAP = (
+    ('small', 'SmallImage'),
+    ('medium', 'MediumImage'),
+    ('large', 'LargeImage')
+)
+
+# Shared session so TCP/TLS connections are kept alive across lookups; keeping the
+# https connections pooled means the handshake cost is paid once, not per request
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4))
+# Ask for gzip explicitly; the xml responses compress ~8-10x so bytes over the wire
+# dominate and decompression happens in C inside zlib
+session.headers['Accept-Encoding'] = 'gzip'
+
+# Shared thread pool; lookups are i/o bound so the GIL releases during socket reads
+executor = ThreadPoolExecutor(max_workers=8)
+
+# Last formatted request timestamp, as [epoch second, formatted string]; Amazon only
+# needs second resolution so back-to-back signatures can share one strftime call
+_ts_cache = [0, '']
+
+class AmazonItemLookup(object):
     """ Class used to access parsed data from an Amazon Product Advertising API Item Lookup Request. """
-    
+
+    # Slot storage instead of a per-instance __dict__; worker pools create many of these
+    __slots__ = ('aws_access_key', 'aws_secret_key', 'associate_tag',
+                 '_base_params', '_canonical_template', '_sign')
+
     def __init__(self, aws_access_key, aws_secret_key, associate_tag):
         self.aws_access_key = aws_access_key
         self.aws_secret_key= aws_secret_key
         self.associate_tag = associate_tag
+        # Constant request parameters; only ItemId and Timestamp vary per lookup
+        self._base_params = {
+            'Service' : 'AWSECommerceService',
+            'Operation' : 'ItemLookup',
+            'AWSAccessKeyId' : aws_access_key,
+            'ResponseGroup' : 'EditorialReview,Images,ItemAttributes,OfferSummary,SalesRank',
+            'AssociateTag' : associate_tag,
+            'Version' : '2013-08-01'
+        }
+        # Pre-encoded canonical string template: ItemId and Timestamp sort into fixed
+        # positions among the constant keys, so signing a url only has to quote and
+        # substitute those two values instead of sorting + urlencoding eight pairs
+        placeholders = self._base_params.copy()
+        placeholders['ItemId'] = placeholders['Timestamp'] = '\x00'
+        # Double up literal percent escapes before turning the '%00' markers into format slots
+        self._canonical_template = urllib.urlencode(
+            sorted(placeholders.items())).replace('%', '%%').replace('%%00', '%s')
+        self._sign = self._make_signer(aws_secret_key)
+
+    @staticmethod
+    def _make_signer(aws_secret_key):
+        """ Returns a sign(message) -> digest callable around a pre-keyed hmac-sha256 prototype;
+            .copy()-ing the prototype skips the key schedule on every signature. Prefers the
+            cryptography package's hardware accelerated sha256 when installed. """
+        if CryptoHMAC is not None:
+            hmac_proto = CryptoHMAC(aws_secret_key, crypto_hashes.SHA256(), backend=default_backend())
+            def sign(message):
+                hmac_sha256 = hmac_proto.copy()
+                hmac_sha256.update(message)
+                return hmac_sha256.finalize()
+        else:
+            hmac_proto = hmac.new(aws_secret_key, digestmod=hashlib.sha256)
+            def sign(message):
+                hmac_sha256 = hmac_proto.copy()
+                hmac_sha256.update(message)
+                return hmac_sha256.digest()
+        return sign
 
     def gen_item_lookup_request_url(self, item_id):
         """ Generates a signed item lookup request url as per amazon rest api requirements.
             Request signature spec: https://docs.aws.amazon.com/AWSECommerceService/latest/DG/rest-signature.html
             Signed requests can be verified at http://associates-amazon.s3.amazonaws.com/signed-requests/helper/index.html"""
     
-        url_params = {
-            'Service' : 'AWSECommerceService', 
-            'Operation' : 'ItemLookup',
-            'AWSAccessKeyId' : self.aws_access_key,
-            'ResponseGroup' : 'EditorialReview,Images,ItemAttributes,OfferSummary,SalesRank',
-            'ItemId' : item_id,
-            'AssociateTag' : self.associate_tag,
-            'Version' : '2013-08-01'
-        }
-    
         # Build the Signed a Request
-        # 1. Enter the time stamp.
-        url_params['Timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-     
-        # 3./4. Sort the URL parameter / value pairs by byte value
-        keys = url_params.keys()
-        keys.sort()
-        values = map(url_params.get, keys)
-    
-        # 2./5. Join the sorted param
-        canonical_string = urllib.urlencode(zip(keys,values))
+        # 1. Enter the time stamp (cached at 1 second granularity).
+        now = int(time.time())
+        if now != _ts_cache[0]:
+            _ts_cache[1] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now))
+            _ts_cache[0] = now
+
+        # 2.-5. Fill the per-request fields into the pre-encoded, byte-sorted canonical string
+        canonical_string = self._canonical_template % (
+            urllib.quote(item_id, safe=''), urllib.quote(_ts_cache[1], safe=''))
     
         # 6. Prepend the following string before the canonical string 
         string_to_sign = "GET\nwebservices.amazon.com\n/onca/xml\n%s" % canonical_string
     
         # 7./8. Calculate HMAC with SHA256 using the string to sign
-        signature = hmac.new(
-            key=self.aws_secret_key,
-            msg=string_to_sign,
-            digestmod=hashlib.sha256).digest()
-        signature = base64.encodestring(signature).strip()
+        signature = self._sign(string_to_sign)
+        signature = base64.b64encode(signature)
     
-        # 9. URL encode the signature
-        urlencoded_signature = urllib.quote_plus(signature)
+        # 9. URL encode the signature; base64 output only ever needs '+', '/' and '=' escaped
+        urlencoded_signature = signature.replace('+', '%2B').replace('/', '%2F').replace('=', '%3D')
         
         # 10. Add the signature to the request
-        canonical_string += "&Signature=%s" % urlencoded_signature
-    
-        return "http://webservices.amazon.com/onca/xml?" + canonical_string
+        return "https://webservices.amazon.com/onca/xml?%s&Signature=%s" % (
+            canonical_string, urlencoded_signature)
 
     def parse_item_response(self, response):
         """ Parses the xml response. Expected output (fields populated if available):
@@ -108,126 +230,124 @@ class AmazonItemLookup():
             'description' : ''
         }
         """
-        result = xmltodict.parse(response)
-        
-        if result['ItemLookupResponse']['Items']['Request']['IsValid'] == 'False':
-            try:
-                print result['ItemLookupResponse']['Items']['Request']['Errors']['Error']['Message']
-            except KeyError:
-                print 'Error: Invalid lookup!'
-            return  {}
-            
-        item = result['ItemLookupResponse']['Items']['Item']
-        
-        # Create default structure to hold parsed data
-        parsed = {
-            'item_attributes' : {
-                'title' : '',
-                'manufacturer' : '',
-                'item_dimensions' : {
-                    'height' : '',
-                    'length' : '',
-                    'weight' : '',
-                    'width' : ''
-                },
-                'size' : '',
-                'warranty' : '',
-                'features' : []
-            },
-            'url' : '',
-            'images' : {
-                'small': {
-                    'height': '',
-                    'width': '',
-                    'url': ''
-                },
-                'medium' : {
-                    'height': '',
-                    'width': '',
-                    'url': ''
-                },
-                'large' : {
-                    'height': '',
-                    'width': '',
-                    'url': ''
-                }
-            },
-            'sales_rank' : '',
-            'price' : '',
-            'description' : ''
-        }        
-        
+        parsed_items = self.parse_items_response(response)
+        return parsed_items[0] if parsed_items else {}
+
+    def parse_items_response(self, response):
+        """ Parses the xml response, returning a list of parsed item dicts, one per <Item>
+            element. Batched lookups (up to 10 comma separated item ids) return several.
+            The document is streamed with iterparse and elements are cleared as they are
+            consumed, so at most one <Item> subtree is held in memory at a time. Accepts
+            either the raw xml bytes or a file-like object such as a response body. """
+        if not hasattr(response, 'read'):
+            response = BytesIO(response)
+        parsed_items = []
+        # Responses are small and id-free, so skip whitespace nodes, xml:id collection
+        # and the huge-document safety valve in libxml2's parser
+        for _, element in etree.iterparse(response, events=('end',),
+                                          remove_blank_text=True, collect_ids=False,
+                                          huge_tree=False):
+            if element.tag == AWS_NS + 'Item':
+                parsed_items.append(self._parse_item(element))
+                element.clear()
+            elif element.tag == AWS_NS + 'Request':
+                if element.findtext('.//' + AWS_NS + 'IsValid') == 'False':
+                    error_message = element.findtext('.//' + AWS_NS + 'Message')
+                    if error_message:
+                        print error_message
+                    else:
+                        print 'Error: Invalid lookup!'
+                    return []
+                element.clear()
+        return parsed_items
+
+    def _parse_item(self, item):
+        """ Extracts the parsed data structure from a single <Item> element. """
+        parsed = copy.deepcopy(_PARSED_TEMPLATE)
+        # Bind the nested dicts once so the loops below hit locals, not repeated lookups
+        item_attributes = parsed['item_attributes']
+        images = parsed['images']
+
+        attrs = item.find(AWS_NS + 'ItemAttributes')
+
         # Parse features, if they exist
-        if 'Feature' in item['ItemAttributes']:
-            if isinstance(item['ItemAttributes']['Feature'], list):
-                parsed['item_attributes']['features'].extend(item['ItemAttributes']['Feature'])
-        else:
-            parsed['item_attributes']['features'].append(item['ItemAttributes']['Feature'])
-
-        # Parse item dimensions, if they exist
-        item_dimensions = item['ItemAttributes'].get('ItemDimensions', {})
-        if item_dimensions:
-            if 'Height' in item_dimensions:
-                parsed['item_attributes']['item_dimensions']['height'] = '{} ({})'.format(
-                    item_dimensions['Height']['#text'], item_dimensions['Height']['@Units'])
-            if 'Length' in item_dimensions:
-                parsed['item_attributes']['item_dimensions']['length'] = '{} ({})'.format(
-                    item_dimensions['Length']['#text'], item_dimensions['Length']['@Units'])
-            if 'Weight' in item_dimensions:
-                parsed['item_attributes']['item_dimensions']['weight'] = '{} ({})'.format(
-                    item_dimensions['Weight']['#text'], item_dimensions['Weight']['@Units'])
-            if 'Width' in item_dimensions:
-                parsed['item_attributes']['item_dimensions']['width'] = '{} ({})'.format(
-                    item_dimensions['Width']['#text'], item_dimensions['Width']['@Units'])
-            
+        for feature in attrs.iterfind(AWS_NS + 'Feature'):
+            item_attributes['features'].append(feature.text)
+
+        # Parse item dimensions, if they exist. Most responses carry the full structure,
+        # so assume it and let the (free until raised) AttributeError from a missing
+        # element fall through to the next field
+        item_dimensions = attrs.find(AWS_NS + 'ItemDimensions')
+        if item_dimensions is not None:
+            for parsed_key, tag in DIM_MAP:
+                try:
+                    dimension = item_dimensions.find(AWS_NS + tag)
+                    item_attributes['item_dimensions'][parsed_key] = '{} ({})'.format(
+                        dimension.text, dimension.get('Units'))
+                except AttributeError:
+                    pass
+
         # Parse remaining item attributes, if they exist
-        parsed['item_attributes']['title'] = item['ItemAttributes'].get('Title', '')
-        parsed['item_attributes']['manufacturer'] = item['ItemAttributes'].get('Manufacturer', '')
-        parsed['item_attributes']['model'] = item['ItemAttributes'].get('Model', '')
-        parsed['item_attributes']['size'] = item['ItemAttributes'].get('Size', '')
-        parsed['item_attributes']['warranty'] = item['ItemAttributes'].get('Warranty', '')
-        
-        parsed['url'] = item.get('DetailPageURL', '')
-        
-        # Parse item images, if they exist
-        if 'SmallImage' in item:
-            parsed['images']['small']['height'] = item['SmallImage']['Height']['#text']
-            parsed['images']['small']['width'] = item['SmallImage']['Width']['#text']
-            parsed['images']['small']['url'] = item['SmallImage']['URL']
-        
-        if 'MediumImage' in item:
-            parsed['images']['medium']['height'] = item['SmallImage']['Height']['#text']
-            parsed['images']['medium']['width'] = item['SmallImage']['Width']['#text']
-            parsed['images']['medium']['url'] = item['MediumImage']['URL']
-            
-        if 'LargeImage' in item:            
-            parsed['images']['large']['height'] = item['LargeImage']['Height']['#text']
-            parsed['images']['large']['width'] = item['LargeImage']['Width']['#text']
-            parsed['images']['large']['url'] = item['LargeImage']['URL']
-        
-        parsed['sales_rank'] = item.get('SalesRank', '')
-        
+        for parsed_key, tag in ATTR_MAP:
+            item_attributes[parsed_key] = attrs.findtext(AWS_NS + tag, '')
+
+        parsed['url'] = item.findtext(AWS_NS + 'DetailPageURL', '')
+
+        # Parse item images, if they exist; same happy-path assumption as above, a
+        # missing image size skips its whole block via the caught AttributeError
+        for parsed_key, tag in IMAGE_MAP:
+            try:
+                image = item.find(AWS_NS + tag)
+                parsed_image = images[parsed_key]
+                parsed_image['height'] = image.findtext(AWS_NS + 'Height')
+                parsed_image['width'] = image.findtext(AWS_NS + 'Width')
+                parsed_image['url'] = image.findtext(AWS_NS + 'URL')
+            except AttributeError:
+                pass
+
+        parsed['sales_rank'] = item.findtext(AWS_NS + 'SalesRank', '')
+
         # Parse lowest new price, if available'
-        if 'OfferSummary' in item and 'LowestNewPrice' in item['OfferSummary']:
-            parsed['price'] = item['OfferSummary']['LowestNewPrice'].get('FormattedPrice', '')
-        
+        parsed['price'] = item.findtext(
+            AWS_NS + 'OfferSummary/' + AWS_NS + 'LowestNewPrice/' + AWS_NS + 'FormattedPrice', '')
+
         # Parse item description, if available'
-        if 'EditorialReviews' in item:
-            if isinstance(item['EditorialReviews'], list):
-                parsed['description'] = item['EditorialReviews'][0]
-            else:
-                parsed['description'] = item['EditorialReviews']['EditorialReview']['Content']
-    
+        parsed['description'] = item.findtext(
+            AWS_NS + 'EditorialReviews/' + AWS_NS + 'EditorialReview/' + AWS_NS + 'Content', '')
+
         return parsed
     
     def get_item_info(self, item_id):
         """ Returns a (dict) containing the parsed amazon product api response for a given item_id. """
         url = self.gen_item_lookup_request_url(item_id)
-        resp = requests.get(url)
+        resp = session.get(url, stream=True)
         if resp.status_code == 200:
-            info = self.parse_item_response(resp.content)
+            # Feed the undecoded body straight to the parser; no full-body bytes copy
+            resp.raw.decode_content = True
+            info = self.parse_item_response(resp.raw)
             return info
         return {}
+
+    def get_items_info(self, item_ids):
+        """ Returns a list of (dict)s containing the parsed amazon product api responses for the
+            given item_ids, batching them 10 per request to cut down on http round trips and
+            fetching the batches concurrently. """
+        chunks = [item_ids[start:start + MAX_IDS_PER_LOOKUP]
+                  for start in xrange(0, len(item_ids), MAX_IDS_PER_LOOKUP)]
+        infos = []
+        for chunk_infos in executor.map(self._lookup_chunk, chunks):
+            infos.extend(chunk_infos)
+        return infos
+
+    def _lookup_chunk(self, item_ids):
+        """ Fetches and parses a single batched lookup of up to 10 item_ids. """
+        url = self.gen_item_lookup_request_url(','.join(item_ids))
+        resp = session.get(url, stream=True)
+        if resp.status_code == 200:
+            # Feed the undecoded body straight to the parser; no full-body bytes copy
+            resp.raw.decode_content = True
+            return self.parse_items_response(resp.raw)
+        return []
         
 if __name__ == '__main__':    
     # Suggested setting up your Amazon Product API keys in your environment variables,
@@ -240,13 +360,13 @@ if __name__ == '__main__':
     
     item_lookup = AmazonItemLookup(aws_access_key, aws_secret_key, associate_tag)    
     
-    # e.g item_id = 'B00F0RRRCC' for https://www.amazon.com/Mediabridge-Ethernet-Cable-Feet-31-399-10B/dp/B00F0RRRCC/  
-    item_id = raw_input('Enter item id to lookup: ')
-    while(item_id):
-        info = item_lookup.get_item_info(item_id)
-        if info:
-            print "Title: " + info['item_attributes']['title']
-            print "Price: " + info['price']
-            print "Features:\n - " + "\n - ".join(info['item_attributes']['features'])
-        
-        item_id = raw_input('Enter item id: ')
\ No newline at end of file
+    # e.g item_id = 'B00F0RRRCC' for https://www.amazon.com/Mediabridge-Ethernet-Cable-Feet-31-399-10B/dp/B00F0RRRCC/
+    item_ids = raw_input('Enter item id(s) to lookup: ').split()
+    while(item_ids):
+        for info in item_lookup.get_items_info(item_ids):
+            if info:
+                print "Title: " + info['item_attributes']['title']
+                print "Price: " + info['price']
+                print "Features:\n - " + "\n - ".join(info['item_attributes']['features'])
+
+        item_ids = raw_input('Enter item id(s): ').split()
\ No newline at end of file